@@ -1,23 +1,27 @@
 # Copyright (c) SCITT Authors
 # Licensed under the MIT License.
+import io
 import os
 import sys
-import time
 import json
-import copy
-import types
+import queue
+import base64
 import pathlib
 import tempfile
 import textwrap
+import functools
 import threading
-import itertools
 import subprocess
 import contextlib
 import unittest.mock
 import pytest
-import myst_parser.parsers.docutils_
-import docutils.nodes
-import docutils.utils
+import markdown_it
+
+try:
+    import inotify_simple
+except ImportError:
+    # Non-Linux platforms fall back to timer based polling
+    inotify_simple = None
 
 from scitt_emulator.client import ClaimOperationError
 
@@ -33,7 +37,16 @@ repo_root = pathlib.Path(__file__).parents[1]
 docs_dir = repo_root.joinpath("docs")
 allowlisted_issuer = "did:web:example.org"
 non_allowlisted_issuer = "did:web:example.com"
+# os.environ stays effectively static for a test run; snapshot it once
+# instead of splicing every variable into a fresh dict per engine
+BASE_ENV = dict(os.environ)
 CLAIM_DENIED_ERROR = {"type": "denied", "detail": "content_address_of_reason"}
+# Only the detail ever varies, so the denial JSON is spliced together from
+# precomputed bytes rather than re-serializing the whole dict per claim
+DENIAL_REASON_PREFIX = (
+    b'{"type": ' + json.dumps(CLAIM_DENIED_ERROR["type"]).encode() + b', "detail": '
+)
+DENIAL_REASON_SUFFIX = b"}"
 CLAIM_DENIED_ERROR_BLOCKED = {
     "type": "denied",
     "detail": textwrap.dedent(
@@ -50,124 +63,228 @@ CLAIM_DENIED_ERROR_BLOCKED = {
 }
 
 
+def scan_cose_files(path):
+    # One getdents pass over the hot directory; Path.glob would compile a
+    # pattern matcher and stat every entry
+    with os.scandir(path) as entries:
+        return [
+            pathlib.Path(entry.path)
+            for entry in entries
+            if entry.name.endswith(".cose")
+            and entry.is_file(follow_symlinks=False)
+        ]
+
+
 class SimpleFileBasedPolicyEngine:
     def __init__(self, config):
-        self.config = config
+        # Resolve every configured path up front; Path.resolve() hits the
+        # filesystem and none of these move while the engine is running
+        self.config = {
+            key: value.resolve() if isinstance(value, pathlib.Path) else value
+            for key, value in config.items()
+        }
 
     def __enter__(self):
         self.stop_event = threading.Event()
-        self.thread = threading.Thread(
+        env = dict(BASE_ENV)
+        env["SCHEMA_PATH"] = str(self.config["schema_path"])
+        env["PYTHONPATH"] = ":".join(
+            BASE_ENV.get("PYTHONPATH", "").split(":") + [str(repo_root.resolve())]
+        )
+        # Long lived worker processes; only the first claim ever pays
+        # interpreter startup and import cost
+        self.validator = self._start_worker(
+            self.config["jsonschema_validator"], env
+        )
+        self.enforcer = self._start_worker(self.config["enforce_policy"], env)
+        # One reason file for the lifetime of the engine, rewritten in place.
+        # The enforcer acks each request before the next claim is processed,
+        # so reuse is race free.
+        self.reason_dir = tempfile.TemporaryDirectory()
+        self.policy_reason_path = pathlib.Path(self.reason_dir.name, "reason.json")
+        self.reason_fd = os.open(
+            self.policy_reason_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+        )
+        # Bounded so a flood of claims applies backpressure to the watcher
+        # instead of growing an unbounded backlog
+        self.claim_queue = queue.Queue(maxsize=64)
+        self.watch_thread = threading.Thread(
+            name="watcher",
+            target=self.watch_workspace,
+        )
+        self.policy_thread = threading.Thread(
             name="policy",
-            target=self.poll_workspace,
-            args=[self.config, self.stop_event],
+            target=self.process_claims,
         )
-        self.thread.start()
+        self.watch_thread.start()
+        self.policy_thread.start()
         return self
 
     def __exit__(self, *args):
         self.stop_event.set()
-        self.thread.join()
+        self.watch_thread.join()
+        self.policy_thread.join()
+        for worker in [self.validator, self.enforcer]:
+            worker.stdin.close()
+            worker.wait()
+        os.close(self.reason_fd)
+        self.reason_dir.cleanup()
 
     @staticmethod
-    def poll_workspace(config, stop_event):
-        operations_path = pathlib.Path(config["storage_path"], "operations")
-        command_jsonschema_validator = [
-            sys.executable,
-            str(config["jsonschema_validator"].resolve()),
-        ]
-        command_enforce_policy = [
-            sys.executable,
-            str(config["enforce_policy"].resolve()),
-        ]
+    def _start_worker(script_path, env):
+        return subprocess.Popen(
+            [sys.executable, "-u", str(script_path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=io.DEFAULT_BUFFER_SIZE,
+            env=env,
+        )
 
-        running = True
-        while running:
-            for cose_path in operations_path.glob("*.cose"):
-                denial = copy.deepcopy(CLAIM_DENIED_ERROR)
-                with open(cose_path, "rb") as stdin_fileobj:
-                    env = {
-                        **os.environ,
-                        "SCHEMA_PATH": str(config["schema_path"].resolve()),
-                        "PYTHONPATH": ":".join(
-                            os.environ.get("PYTHONPATH", "").split(":")
-                            + [str(pathlib.Path(__file__).parents[1].resolve())]
-                        ),
-                    }
-                    exit_code = 0
-                    try:
-                        subprocess.check_output(
-                            command_jsonschema_validator,
-                            stdin=stdin_fileobj,
-                            stderr=subprocess.STDOUT,
-                            env=env,
-                        )
-                    except subprocess.CalledProcessError as error:
-                        denial["detail"] = error.output.decode()
-                        exit_code = error.returncode
-                # EXIT_FAILRUE from validator == MUST block
-                with tempfile.TemporaryDirectory() as tempdir:
-                    policy_reason_path = pathlib.Path(tempdir, "reason.json")
-                    policy_reason_path.write_text(json.dumps(denial))
-                    env = {
-                        **os.environ,
-                        "POLICY_REASON_PATH": str(policy_reason_path),
-                        "POLICY_ACTION": {
-                            0: "insert",
-                        }.get(exit_code, "denied"),
-                    }
-                    command = command_enforce_policy + [cose_path]
-                    exit_code = subprocess.call(command, env=env)
-            time.sleep(0.1)
-            running = not stop_event.is_set()
+    @staticmethod
+    def _worker_request(worker, request):
+        # Newline delimited JSON frames, one response per request
+        worker.stdin.write(json.dumps(request).encode() + b"\n")
+        worker.stdin.flush()
+        return json.loads(worker.stdout.readline())
 
-def docutils_recursively_extract_nodes(node, samples = None):
-    if samples is None:
-        samples = []
-    if isinstance(node, list):
-        node = types.SimpleNamespace(children=node)
-    return samples + list(itertools.chain(*[
-        [
-            child,
-            *docutils_recursively_extract_nodes(child),
-        ]
-        for child in node.children
-        if hasattr(child, "children")
-    ]))
+    def watch_workspace(self):
+        operations_path = pathlib.Path(self.config["storage_path"], "operations")
+
+        # Prefer event driven wakeups over pure timer based polling so new
+        # claims are picked up as soon as their .cose file is written
+        watcher = None
+        if inotify_simple is not None:
+            watcher = inotify_simple.INotify()
+            watcher.add_watch(
+                str(operations_path),
+                inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO,
+            )
+
+        # Claims already present before the watch began
+        for cose_path in scan_cose_files(operations_path):
+            self.claim_queue.put(cose_path)
+        while True:
+            if watcher is not None:
+                # Block until something lands in the workspace. The timeout is
+                # only there to keep shutdown via stop_event responsive. Only
+                # enqueue fully written claim files; wakeups for the operation
+                # .json can land mid-write of the .cose file.
+                for event in watcher.read(timeout=100):
+                    if event.name.endswith(".cose"):
+                        self.claim_queue.put(operations_path / event.name)
+                if self.stop_event.is_set():
+                    break
+            else:
+                for cose_path in scan_cose_files(operations_path):
+                    self.claim_queue.put(cose_path)
+                # wait() returns True as soon as stop_event is set, so
+                # shutdown does not eat the full poll interval
+                if self.stop_event.wait(0.1):
+                    break
+        if watcher is not None:
+            watcher.close()
+
+    def process_claims(self):
+        while True:
+            try:
+                cose_path = self.claim_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    break
+                continue
+            # The fallback watcher re-enqueues anything still on disk, so the
+            # claim may have been consumed by the service already
+            if cose_path.is_file():
+                self.process_claim(cose_path)
+
+    def process_claim(self, cose_path):
+        # Claim bytes travel in band so the worker never re-opens the file;
+        # .cose claims are small enough to read whole
+        verdict = self._worker_request(
+            self.validator,
+            {
+                "path": str(cose_path),
+                "claim": base64.b64encode(cose_path.read_bytes()).decode(),
+            },
+        )
+        # EXIT_FAILRUE from validator == MUST block
+        request = {
+            "path": verdict["path"],
+            "action": {
+                0: "insert",
+            }.get(verdict["exit_code"], "denied"),
+        }
+        if request["action"] == "insert":
+            # Success carries no reason; drop the insert marker directly
+            # instead of a round trip to the enforcer. The service only
+            # checks for the file's presence.
+            cose_path.with_suffix(".policy.insert").write_text("")
+        else:
+            # Rewrite the kept-open reason file in place; no open/close per
+            # denial and only the detail gets JSON encoded
+            os.lseek(self.reason_fd, 0, os.SEEK_SET)
+            os.ftruncate(self.reason_fd, 0)
+            os.write(
+                self.reason_fd,
+                DENIAL_REASON_PREFIX
+                + json.dumps(verdict["detail"]).encode()
+                + DENIAL_REASON_SUFFIX,
+            )
+            request["reason_path"] = str(self.policy_reason_path)
+            self._worker_request(self.enforcer, request)
 
-def docutils_find_code_samples(nodes):
+@functools.lru_cache(maxsize=16)
+def docs_code_samples(doc_path_str, doc_mtime_ns):
+    # Cache on (path, mtime) so repeated tests against the same unmodified doc
+    # reuse the token stream instead of re-parsing on every invocation. A
+    # CommonMark token scan is all that is needed to pair each sample name
+    # with the fenced block that follows it; no document tree gets built.
+    #
+    # **strong.suffix**
+    #
+    # ```language
+    # content
+    # ````
+    tokens = markdown_it.MarkdownIt().parse(
+        pathlib.Path(doc_path_str).read_text()
+    )
     samples = {}
-    for i, node in enumerate(nodes):
-        # Look ahead for next literal allow with code sample. Pattern is:
-        #
-        # **strong.suffix**
-        #
-        # ```language
-        # content
-        # ````
-        # TODO Gracefully handle expections to index out of bounds
-        if (
-            isinstance(node, docutils.nodes.strong)
-            and isinstance(nodes[i + 3], docutils.nodes.literal_block)
-        ):
-            samples[node.astext()] = nodes[i + 3].astext()
+    pending_name = None
+    for token in tokens:
+        if token.type == "inline":
+            # markdown-it pads the strong with empty text tokens
+            children = [
+                child
+                for child in token.children
+                if child.type != "text" or child.content
+            ]
+            if [child.type for child in children] == [
+                "strong_open",
+                "text",
+                "strong_close",
+            ]:
+                pending_name = children[1].content
+            else:
+                pending_name = None
+        elif token.type == "fence" and pending_name is not None:
+            samples[pending_name] = token.content
+            pending_name = None
     return samples
 
-def test_docs_registration_policies(tmp_path):
+@pytest.fixture(scope="module")
+def registration_policy_service(tmp_path_factory):
+    # One CCF tree and one policy engine shared by every claim submission
+    # derived from the doc, so xdist workers only pay setup once
+    tmp_path = tmp_path_factory.mktemp("registration_policies")
     workspace_path = tmp_path / "workspace"
 
-    claim_path = tmp_path / "claim.cose"
-    receipt_path = tmp_path / "claim.receipt.cbor"
-    entry_id_path = tmp_path / "claim.entry_id.txt"
-    retrieved_claim_path = tmp_path / "claim.retrieved.cose"
-
     # Grab code samples from docs
     # TODO Abstract into abitrary docs testing code
     doc_path = docs_dir.joinpath("registration_policies.md")
-    markdown_parser = myst_parser.parsers.docutils_.Parser()
-    document = docutils.utils.new_document(str(doc_path.resolve()))
-    parsed = markdown_parser.parse(doc_path.read_text(), document)
-    nodes = docutils_recursively_extract_nodes(document)
-    for name, content in docutils_find_code_samples(nodes).items():
+    samples = docs_code_samples(
+        str(doc_path.resolve()), doc_path.stat().st_mtime_ns
+    )
+    for name, content in samples.items():
         tmp_path.joinpath(name).write_text(content)
 
     with Service(
@@ -185,38 +302,62 @@ def test_docs_registration_policies(tmp_path):
             "schema_path": tmp_path.joinpath("allowlist.schema.json"),
         }
     ) as policy_engine:
-        # set the policy to enforce
-        service.server.app.scitt_service.service_parameters["insertPolicy"] = "external"
+        yield service
 
-        # create denied claim
-        command = [
-            "client",
-            "create-claim",
-            "--out",
-            claim_path,
-            "--issuer",
-            non_allowlisted_issuer,
-            "--content-type",
-            content_type,
-            "--payload",
-            payload,
-        ]
-        execute_cli(command)
-        assert os.path.exists(claim_path)
 
-        # submit denied claim
-        command = [
-            "client",
-            "submit-claim",
-            "--claim",
-            claim_path,
-            "--out",
-            receipt_path,
-            "--out-entry-id",
-            entry_id_path,
-            "--url",
-            service.url
-        ]
+@pytest.fixture(autouse=True)
+def enforce_external_insert_policy(registration_policy_service):
+    # Reset the policy to enforce before every test so cases stay
+    # independent of whatever a previous case did to service parameters
+    scitt_service = registration_policy_service.server.app.scitt_service
+    scitt_service.service_parameters["insertPolicy"] = "external"
+
+
+@pytest.mark.parametrize(
+    "issuer,expect_denied",
+    [
+        (non_allowlisted_issuer, True),
+        (allowlisted_issuer, False),
+    ],
+)
+def test_docs_registration_policies(
+    registration_policy_service, tmp_path, issuer, expect_denied
+):
+    service = registration_policy_service
+    claim_path = tmp_path / "claim.cose"
+    receipt_path = tmp_path / "claim.receipt.cbor"
+    entry_id_path = tmp_path / "claim.entry_id.txt"
+
+    # create claim
+    command = [
+        "client",
+        "create-claim",
+        "--out",
+        claim_path,
+        "--issuer",
+        issuer,
+        "--content-type",
+        content_type,
+        "--payload",
+        payload,
+    ]
+    execute_cli(command)
+    assert os.path.exists(claim_path)
+
+    # submit claim
+    command = [
+        "client",
+        "submit-claim",
+        "--claim",
+        claim_path,
+        "--out",
+        receipt_path,
+        "--out-entry-id",
+        entry_id_path,
+        "--url",
+        service.url
+    ]
+    if expect_denied:
         check_error = None
         try:
             execute_cli(command)
@@ -227,36 +368,7 @@ def test_docs_registration_policies(tmp_path):
         assert check_error.operation["error"] == CLAIM_DENIED_ERROR_BLOCKED
         assert not os.path.exists(receipt_path)
         assert not os.path.exists(entry_id_path)
-
-        # create accepted claim
-        command = [
-            "client",
-            "create-claim",
-            "--out",
-            claim_path,
-            "--issuer",
-            allowlisted_issuer,
-            "--content-type",
-            content_type,
-            "--payload",
-            payload,
-        ]
-        execute_cli(command)
-        assert os.path.exists(claim_path)
-
-        # submit accepted claim
-        command = [
-            "client",
-            "submit-claim",
-            "--claim",
-            claim_path,
-            "--out",
-            receipt_path,
-            "--out-entry-id",
-            entry_id_path,
-            "--url",
-            service.url
-        ]
+    else:
         execute_cli(command)
         assert os.path.exists(receipt_path)
         assert os.path.exists(entry_id_path)